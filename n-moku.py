@@ -1,6 +1,11 @@
+import array
+import concurrent.futures
+import functools
+import gzip
 import os
 import pickle
 import random
+import time
 import tkinter as tk
 from tkinter import messagebox
 
@@ -9,23 +14,166 @@ WIN_LENGTH = 4
 CELL_SIZE = 40
 PADDING = 10
 TRAINING_EPISODES = 100000
+CPU_SEARCH_DEPTH = 20
+CPU_THINK_TIME = 0.5
+# 探索中にこのノード数ごとに制限時間を確認する
+DEADLINE_CHECK_NODES = 256
+SCORE_WIN = 1_000_000
+SCORE_INF = 10 * SCORE_WIN
+DIRECTIONS = ((1, 0), (0, 1), (1, 1), (1, -1))
+Q_TABLE_VERSION = 8
+
+# Zobristハッシュ用の乱数表。Q表のキーにも使うので毎回同じ値になるようシードを固定する
+_zobrist_rng = random.Random(0x6E6D6F6B75)
+ZOBRIST = [[_zobrist_rng.getrandbits(64) for _ in range(2)] for _ in range(BOARD_SIZE * BOARD_SIZE)]
+ZOBRIST_SIDE = _zobrist_rng.getrandbits(64)
+
+# Q表の状態キー：盤面を3進数（空=0, o=1, x=2）に詰めた整数。マス i の桁の重みが POW3[i]
+# （石が SYMMETRY_PLIES 個未満の序盤だけ、8通りの対称変換のうち最小になるものを使う。QLearningAgent.canonical()）
+POW3 = [3 ** i for i in range(BOARD_SIZE * BOARD_SIZE)]
+# 対称な局面が実際に重なるのは序盤だけなので、それ以降は8通りのキーを持ち回らない
+SYMMETRY_PLIES = 4
+MARK_DIGIT = {"o": 1, "x": 2}
+
+OPPONENT = {"o": "x", "x": "o"}
+# 手番ごとの表（Zobrist乱数・ヒストリー）の添字
+SIDE_INDEX = {"o": 0, "x": 1}
+
+# Game.board の各マスの値（空きは0）
+MARK_VALUE = {"o": 1, "x": -1}
+VALUE_MARK = {1: "o", -1: "x"}
+
+# 置換表エントリの種別
+TT_EXACT = 0
+TT_LOWER = 1
+TT_UPPER = 2
+
+
+@functools.lru_cache(maxsize=None)
+def win_masks(board_size, win_length):
+    """
+    方向ごとのシフト量 → 「そこから win_length 個並べても盤外にはみ出さない」始点のビットマスク。
+    ビット i はマス i（= row * board_size + col）に対応する。
+    """
+    n = board_size
+    k = win_length
+    masks = {1: 0, n: 0, n + 1: 0, n - 1: 0}
+    for row in range(n):
+        for col in range(n):
+            bit = 1 << (row * n + col)
+            if col <= n - k:
+                masks[1] |= bit
+            if row <= n - k:
+                masks[n] |= bit
+                if col <= n - k:
+                    masks[n + 1] |= bit
+                if col >= k - 1:
+                    masks[n - 1] |= bit
+    return masks
+
+
+@functools.lru_cache(maxsize=None)
+def board_lines(board_size, win_length):
+    """
+    マスごとに「そのマスを通る (線, 線内の位置)」の一覧を返す。
+    線は win_length 個以上並べられる縦・横・斜めのマス番号のタプル。
+    """
+    n = board_size
+    lines = []
+    for dr, dc in DIRECTIONS:
+        for row in range(n):
+            for col in range(n):
+                # 1つ手前が盤外になるマスを始点として線を作る
+                if 0 <= row - dr < n and 0 <= col - dc < n:
+                    continue
+                line = []
+                r, c = row, col
+                while 0 <= r < n and 0 <= c < n:
+                    line.append(r * n + c)
+                    r += dr
+                    c += dc
+                if len(line) >= win_length:
+                    lines.append(tuple(line))
+
+    through = [[] for _ in range(n * n)]
+    for line in lines:
+        for pos, idx in enumerate(line):
+            through[idx].append((line, pos))
+    return tuple(tuple(t) for t in through)
+
+
+@functools.lru_cache(maxsize=None)
+def shift_masks(board_size):
+    """
+    ビットボードを左右に1マスずらすときに行をまたいだビットを消すマスク
+    （列0以外 / 列 board_size-1 以外）と、盤全体のマスクを返す。
+    """
+    n = board_size
+    not_first_col = 0
+    not_last_col = 0
+    for row in range(n):
+        for col in range(n):
+            bit = 1 << (row * n + col)
+            if col > 0:
+                not_first_col |= bit
+            if col < n - 1:
+                not_last_col |= bit
+    return not_first_col, not_last_col, (1 << (n * n)) - 1
+
+
+@functools.lru_cache(maxsize=None)
+def symmetries(board_size):
+    """
+    盤の8通りの対称変換（回転4通り × 鏡映の有無）。
+    各変換はマス番号の置換のタプルで、perm[idx] が変換後のマス番号。
+    """
+    n = board_size
+    transforms = (
+        lambda r, c: (r, c),
+        lambda r, c: (c, n - 1 - r),
+        lambda r, c: (n - 1 - r, n - 1 - c),
+        lambda r, c: (n - 1 - c, r),
+        lambda r, c: (r, n - 1 - c),
+        lambda r, c: (c, r),
+        lambda r, c: (n - 1 - r, c),
+        lambda r, c: (n - 1 - c, n - 1 - r),
+    )
+    perms = []
+    for transform in transforms:
+        perm = []
+        for idx in range(n * n):
+            r, c = transform(*divmod(idx, n))
+            perm.append(r * n + c)
+        perms.append(tuple(perm))
+    return tuple(perms)
 
 
 class Game:
     """
     ルール・状態のみを持つ（UIに依存しない）
-    board: None / "o" / "x"
-    turn: 0,1,2,...（偶数=先手番）
+    board: array('b')。0 = 空き / 1 = "o" / -1 = "x"（MARK_VALUE）
+    bb_o, bb_x, occ: 同じ盤面のビットボード（ビット i = マス i）
+    turn: 0,1,2,...（偶数=先手番）。play()/undo() でしか増減しないので盤上の石の数でもある
+    winner_cached: 直前の着手で勝負がついていればその mark（play() が更新する）
     """
     def __init__(self, board_size=BOARD_SIZE, win_length=WIN_LENGTH, human_first=True):
         self.board_size = board_size
         self.win_length = win_length
         self.human_first = human_first
         self.human_mark = "o" if human_first else "x"
-        self.cpu_mark = "x" if human_first else "o"
-        self.board = [None] * (board_size * board_size)
+        self.cpu_mark = OPPONENT[self.human_mark]
+        self.board = array.array("b", bytes(board_size * board_size))
+        self.bb_o = 0
+        self.bb_x = 0
+        self.occ = 0
+        self.cells = board_size * board_size
+        self.lines_through = board_lines(board_size, win_length)
         self.turn = 0
         self.game_over = False
+        self.winner_cached = None
+        self.zkey = 0
+        self.tt = {}
+        self.reset_search_tables()
 
     def reset(self, human_first: bool):
         self.__init__(self.board_size, self.win_length, human_first)
@@ -36,165 +184,503 @@ class Game:
                 (self.turn % 2 == 1 and not self.human_first))
 
     def legal_move(self, idx: int) -> bool:
-        return 0 <= idx < len(self.board) and self.board[idx] is None
+        return 0 <= idx < len(self.board) and not self.board[idx]
 
     def play(self, idx: int, mark: str) -> bool:
         """合法なら着手してturnを進める。成功ならTrue。"""
         if self.game_over or not self.legal_move(idx):
             return False
-        self.board[idx] = mark
+        self.board[idx] = MARK_VALUE[mark]
+        bit = 1 << idx
+        if mark == "o":
+            self.bb_o |= bit
+        else:
+            self.bb_x |= bit
+        self.occ |= bit
+        self.zkey ^= ZOBRIST[idx][SIDE_INDEX[mark]]
         self.turn += 1
+        if self.is_win_at(idx, mark):
+            self.winner_cached = mark
         return True
 
+    def undo(self, idx: int):
+        """探索用：play() で置いた石を取り除いてturnを戻す。"""
+        mark = VALUE_MARK[self.board[idx]]
+        self.board[idx] = 0
+        bit = 1 << idx
+        if mark == "o":
+            self.bb_o &= ~bit
+        else:
+            self.bb_x &= ~bit
+        self.occ &= ~bit
+        self.zkey ^= ZOBRIST[idx][SIDE_INDEX[mark]]
+        self.turn -= 1
+        # 勝ちが決まった局面からは先を読まないので、戻した局面は必ず未決着
+        self.winner_cached = None
+
+    def hash_key(self, mark) -> int:
+        """盤面のZobristハッシュに手番 mark を加えたキー（置換表用）"""
+        return self.zkey ^ (ZOBRIST_SIDE if mark == "x" else 0)
+
     def available_moves(self):
-        return [i for i, v in enumerate(self.board) if v is None]
+        return [i for i, v in enumerate(self.board) if not v]
+
+    def reset_search_tables(self, max_depth=CPU_SEARCH_DEPTH):
+        """探索の手順付け用の表（キラー手・ヒストリー）とノード数を初期化する"""
+        self.killers = [[None, None] for _ in range(max_depth + 1)]
+        self.history = [[0] * len(self.board) for _ in range(2)]
+        self.nodes = 0
 
     def cpu_choose_move(self):
-        moves = self.available_moves()
-        if not moves:
-            return None
-        return random.choice(moves)
+        return self.search(self.cpu_mark)
+
+    def search(self, mark, max_depth=CPU_SEARCH_DEPTH, time_limit=CPU_THINK_TIME):
+        """
+        反復深化つきαβ探索で mark の最善手を返す。
+        深さ1から順に読み、制限時間を過ぎたら読みかけの深さは捨てて、完了している最深の結果を使う。
+        """
+        deadline = time.monotonic() + time_limit
+        self.reset_search_tables(max_depth)
+        best_move = None
+        for depth in range(1, max_depth + 1):
+            try:
+                # 深さ1は必ず読み切って、最低でも1手は返せるようにする
+                score, move = self.negamax(depth, -SCORE_INF, SCORE_INF, mark, pv_move=best_move,
+                                           deadline=deadline if depth > 1 else None)
+            except TimeoutError:
+                break
+            if move is not None:
+                best_move = move
+            if abs(score) >= SCORE_WIN or time.monotonic() >= deadline:
+                break
+        return best_move
+
+    def negamax(self, depth, alpha, beta, mark, pv_move=None, deadline=None):
+        """
+        mark 手番から見た (評価値, 最善手) を返す。
+        deadline（time.monotonic() の値）を過ぎると TimeoutError を送出する。盤面は元に戻っている。
+        """
+        if deadline is not None:
+            self.nodes += 1
+            if self.nodes % DEADLINE_CHECK_NODES == 0 and time.monotonic() > deadline:
+                raise TimeoutError
+
+        moves = self.candidate_moves()
+        if depth == 0 or not moves:
+            return self.evaluate(mark), None
+
+        key = self.hash_key(mark)
+        alpha_orig = alpha
+        tt_move = None
+        entry = self.tt.get(key)
+        if entry is not None:
+            tt_move = entry["m"]
+            if entry["d"] >= depth:
+                if entry["flag"] == TT_EXACT:
+                    return entry["v"], tt_move
+                if entry["flag"] == TT_LOWER:
+                    alpha = max(alpha, entry["v"])
+                else:
+                    beta = min(beta, entry["v"])
+                if alpha >= beta:
+                    return entry["v"], tt_move
+        if pv_move is None:
+            pv_move = tt_move
+        # search() の max_depth より深く直接呼ばれたときはキラー手の枠を足す
+        if depth >= len(self.killers):
+            self.killers.extend([None, None] for _ in range(depth + 1 - len(self.killers)))
+
+        other = OPPONENT[mark]
+        best_score = -SCORE_INF
+        best_move = None
+        for idx in self.order_moves(moves, depth, mark, pv_move):
+            self.play(idx, mark)
+            try:
+                if self.winner_cached == mark:
+                    # 残り深さが大きい（＝早く勝てる）ほど高評価
+                    score = SCORE_WIN + depth
+                elif self.turn == self.cells:
+                    score = 0
+                else:
+                    score = -self.negamax(depth - 1, -beta, -alpha, other, deadline=deadline)[0]
+            finally:
+                self.undo(idx)
+
+            if score > best_score:
+                best_score = score
+                best_move = idx
+            if best_score > alpha:
+                alpha = best_score
+            if alpha >= beta:
+                killers = self.killers[depth]
+                if killers[0] != idx:
+                    killers[1] = killers[0]
+                    killers[0] = idx
+                self.history[SIDE_INDEX[mark]][idx] += depth * depth
+                break
+
+        if best_score <= alpha_orig:
+            flag = TT_UPPER
+        elif best_score >= beta:
+            flag = TT_LOWER
+        else:
+            flag = TT_EXACT
+        self.tt[key] = {"d": depth, "v": best_score, "flag": flag, "m": best_move}
+        return best_score, best_move
 
-    def winner(self):
-        directions = [(1, 0), (0, 1), (1, 1), (1, -1)]
+    def candidate_moves(self):
+        """既存の石からチェビシェフ距離2以内の空きマス（初手は中央）"""
         n = self.board_size
+        if not self.occ:
+            return [(n // 2) * n + n // 2]
+
+        # 石のビットボードを左右に2マス、上下に2マス膨らませる
+        not_first_col, not_last_col, full = shift_masks(n)
+        near = self.occ
+        for _ in range(2):
+            near |= ((near << 1) & not_first_col) | ((near >> 1) & not_last_col)
+        for _ in range(2):
+            near |= (near << n) | (near >> n)
+        near &= full & ~self.occ
+
+        moves = []
+        while near:
+            low = near & -near
+            moves.append(low.bit_length() - 1)
+            near ^= low
+        return moves
+
+    def order_moves(self, moves, depth, mark, pv_move=None):
+        """
+        前回反復（置換表）の最善手 → キラー手 → ヒストリー値の高い手
+        → 脅威の大きい手 → 中央に近い手 の順に並べる
+        """
+        n = self.board_size
+        center = (n - 1) / 2
+        killers = self.killers[depth]
+        history = self.history[SIDE_INDEX[mark]]
 
-        for idx, mark in enumerate(self.board):
-            if mark not in ("o", "x"):
-                continue
-
+        def key(idx):
             row, col = divmod(idx, n)
+            threat = max(self.run_through(idx, m) for m in ("o", "x"))
+            return (idx != pv_move, idx not in killers, -history[idx], -threat,
+                    max(abs(row - center), abs(col - center)))
+
+        return sorted(moves, key=key)
+
+    def run_length(self, line, pos, mark):
+        """線 line の pos に mark があるとしたときの、pos を含む連の長さ"""
+        board = self.board
+        value = MARK_VALUE[mark]
+        count = 1
+        i = pos - 1
+        while i >= 0 and board[line[i]] == value:
+            count += 1
+            i -= 1
+        i = pos + 1
+        while i < len(line) and board[line[i]] == value:
+            count += 1
+            i += 1
+        return count
+
+    def run_through(self, idx, mark):
+        """idx に mark を置いたときにできる最長の連の長さ"""
+        return max((self.run_length(line, pos, mark) for line, pos in self.lines_through[idx]), default=1)
+
+    def evaluate(self, mark):
+        """
+        盤面の静的評価（mark 側から見た値）。
+        win_length マスの窓のうち相手の石を含まないものを、中の自分の石の数に応じて重みづけして数える。
+        """
+        score = self.window_score(self.bb_o, self.bb_x) - self.window_score(self.bb_x, self.bb_o)
+        return score if mark == "o" else -score
+
+    def window_score(self, own, opp):
+        """
+        own 側の窓の点数。ビットボードのシフトとAND、popcount（int.bit_count）だけで計算する。
+        窓は始点のビットで表し、石が c 個入った窓1つにつき 10 ** c 点とする。
+        """
+        k = self.win_length
+        score = 0
+        for shift, mask in win_masks(self.board_size, k).items():
+            # 相手の石を含まない窓の始点
+            blocked = 0
+            for j in range(k):
+                blocked |= opp >> (j * shift)
+            open_starts = mask & ~blocked
+            if not open_starts:
+                continue
 
-            for dr, dc in directions:
-                count = 1
-                nr = row + dr
-                nc = col + dc
-
-                while 0 <= nr < n and 0 <= nc < n and self.board[nr * n + nc] == mark:
-                    count += 1
-                    if count >= self.win_length:
-                        return mark
-                    nr += dr
-                    nc += dc
-
-        return None
+            # 窓の中の自分の石の数を、始点ごとの2進カウンタで数える（planes[b] が 2**b の桁）
+            planes = []
+            for j in range(k):
+                carry = (own >> (j * shift)) & open_starts
+                for b in range(len(planes)):
+                    planes[b], carry = planes[b] ^ carry, planes[b] & carry
+                    if not carry:
+                        break
+                if carry:
+                    planes.append(carry)
+
+            # 石が k 個の窓は勝ちなので探索側で扱う
+            for count in range(1, min(k, 1 << len(planes))):
+                selected = open_starts
+                for b, plane in enumerate(planes):
+                    selected &= plane if count >> b & 1 else ~plane
+                score += 10 ** count * selected.bit_count()
+        return score
+
+    def is_win_at(self, idx, mark) -> bool:
+        """idx に置いた mark を通る線だけを見て勝ちを判定する"""
+        for line, pos in self.lines_through[idx]:
+            if self.run_length(line, pos, mark) >= self.win_length:
+                return True
+        return False
 
     def is_draw(self) -> bool:
-        return all(v is not None for v in self.board) and self.winner() is None
+        return self.turn == self.cells and self.winner_cached is None
 
 
 class QLearningAgent:
+    """
+    q: 状態キー * n_actions + 行動 → Q値。更新したことのある (状態, 行動) だけを持つ疎な表
+    （自己対戦では1つの状態で1～2手しか更新されないので、状態ごとに全行動ぶんの行を持つと大半が0になる）。
+    序盤（石が SYMMETRY_PLIES 個未満）は状態も行動も盤の対称変換で正規化した座標で持つ（対称な局面は同じエントリを共有する）。
+    正規化に使った置換を perm とすると、実際の手 a の Q値のキーは 状態キー * n_actions + perm[a]。
+    それ以降は正規化せず、perm は恒等置換になる。
+    states: q にエントリのある状態キーの集合（未知の状態なら全行動を引かずに済ませるため）
+    """
     def __init__(self, board_size, win_length, alpha=0.3, gamma=0.9, epsilon=0.3):
         self.board_size = board_size
         self.win_length = win_length
         self.alpha = alpha
         self.gamma = gamma
         self.epsilon = epsilon
+        self.n_actions = board_size * board_size
+        self.syms = symmetries(board_size)
         self.q = {}
+        self.states = set()
 
     def q_filename(self):
-        filename = f"q_table_{self.board_size}_{self.win_length}_{TRAINING_EPISODES}.pkl"
+        filename = f"q_table_{self.board_size}_{self.win_length}_{TRAINING_EPISODES}_v{Q_TABLE_VERSION}.pkl.gz"
         base_dir = os.path.dirname(os.path.abspath(__file__))
         return os.path.join(base_dir, filename)
 
     def load_if_exists(self):
         filename = self.q_filename()
         if os.path.exists(filename):
-            with open(filename, "rb") as f:
-                self.q = pickle.load(f)
+            with gzip.open(filename, "rb") as f:
+                keys, values = pickle.load(f)
+            self.q = dict(zip(self.unpack_keys(keys), values))
+            self.states = {key // self.n_actions for key in self.q}
             return True
         return False
 
     def save(self):
         filename = self.q_filename()
-        with open(filename, "wb") as f:
-            pickle.dump(self.q, f)
+        with gzip.open(filename, "wb", compresslevel=1) as f:
+            pickle.dump(self.pack_table(self.q), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def pack_table(self, q):
+        """
+        大量のintとfloatをそのままpickleすると遅いので、キーのバイト列と float32 の配列にまとめる。
+        キーは64ビットに収まらないので固定長のバイト列として連結する。
+        """
+        width = self.key_bytes()
+        keys = bytearray()
+        for key in q:
+            keys += key.to_bytes(width, "little")
+        return keys, array.array("f", q.values())
+
+    def unpack_keys(self, keys):
+        width = self.key_bytes()
+        return [int.from_bytes(keys[i:i + width], "little") for i in range(0, len(keys), width)]
+
+    def canonical(self, keys, current_mark):
+        """
+        8通りの対称変換それぞれで詰めた盤面キー keys から最小のものを選び、
+        手番を1ビット加えた状態キーと、その変換の置換を返す。
+        """
+        k = min(range(len(keys)), key=keys.__getitem__)
+        return (keys[k] << 1) | (current_mark == "x"), self.syms[k]
 
     def encode_state(self, board, current_mark):
-        chars = []
-        for v in board:
-            if v is None:
-                chars.append(".")
-            else:
-                chars.append(v)
-        return current_mark + ":" + "".join(chars)
-
-    def get_q(self, state, action):
-        return self.q.get((state, action), 0.0)
+        """盤面から状態キーと置換を計算する（序盤だけ対称変換で正規化する）"""
+        syms = self.syms
+        if len(board) - board.count(0) >= SYMMETRY_PLIES:
+            syms = syms[:1]
+        keys = []
+        for perm in syms:
+            key = 0
+            for idx, v in enumerate(board):
+                if v:
+                    # o=1, x=-1 を3進の桁 1, 2 に直す
+                    key += v % 3 * POW3[perm[idx]]
+            keys.append(key)
+        return self.canonical(keys, current_mark)
+
+    def key_bytes(self):
+        """Q表のキー（状態キー * n_actions + 行動）1個を保存するのに必要なバイト数"""
+        max_key = 2 * 3 ** (self.board_size * self.board_size) * self.n_actions
+        return (max_key.bit_length() + 7) // 8
+
+    def best_action(self, state, available_moves, perm):
+        """available_moves（実際の座標）から Q値 最大の手を返す。perm は encode_state() の置換"""
+        if not available_moves:
+            return None
+        if state not in self.states:
+            # 未知の状態は全行動が0.0で同点
+            return random.choice(available_moves)
 
-    def best_action(self, state, available_moves):
+        q = self.q
+        base = state * self.n_actions
         best_val = None
         best_actions = []
         for action in available_moves:
-            value = self.get_q(state, action)
+            value = q.get(base + perm[action], 0.0)
             if best_val is None or value > best_val:
                 best_val = value
                 best_actions = [action]
             elif value == best_val:
                 best_actions.append(action)
-        if not best_actions:
-            return None
         return random.choice(best_actions)
 
-    def choose_action(self, board, current_mark, available_moves, training=False):
-        state = self.encode_state(board, current_mark)
-        if training and random.random() < self.epsilon:
-            return random.choice(available_moves)
-        return self.best_action(state, available_moves)
-
-    def update(self, state, action, reward, next_state, next_moves, done):
-        current = self.get_q(state, action)
+    def update(self, state, action, reward, next_state, next_moves, done, next_perm=None):
+        """
+        action は正規化した座標。next_moves は実際の座標で、next_perm でnext_stateの座標に直す。
+        """
+        q = self.q
+        n = self.n_actions
+        key = state * n + action
         if done:
             target = reward
         else:
             max_next = 0.0
-            if next_moves:
-                max_next = max(self.get_q(next_state, a) for a in next_moves)
+            if next_moves and next_state in self.states:
+                base = next_state * n
+                max_next = max(q.get(base + next_perm[a], 0.0) for a in next_moves)
             target = reward + self.gamma * max_next
-        self.q[(state, action)] = current + self.alpha * (target - current)
+        current = q.get(key, 0.0)
+        q[key] = current + self.alpha * (target - current)
+        self.states.add(state)
 
     def train_self_play(self, episodes=TRAINING_EPISODES):
+        epsilon = self.epsilon
+        # random.random をローカルに束縛し、探索手も random.choice を経由せず1回の乱数で選ぶ
+        rand = random.random
+        syms = self.syms
+        identity = syms[0]
         for _ in range(episodes):
             game = Game(board_size=self.board_size, win_length=self.win_length, human_first=True)
             current_mark = "o"
             last_sa = {}
-
-            while True:
-                moves = game.available_moves()
-                if not moves:
-                    break
-
-                state = self.encode_state(game.board, current_mark)
-                action = self.choose_action(game.board, current_mark, moves, training=True)
+            moves = game.available_moves()
+            # 対称変換ごとの盤面キー。着手のたびに置いた石の桁を足して更新する
+            # （正規化しなくなったら恒等変換の keys[0] だけを更新する）
+            keys = [0] * len(syms)
+            state, perm = self.canonical(keys, current_mark)
+
+            while moves:
+                # ε-greedy。状態キーは着手ごとに差分更新しているので盤面を再エンコードしない
+                if rand() < epsilon:
+                    action = moves[int(rand() * len(moves))]
+                else:
+                    action = self.best_action(state, moves, perm)
                 game.play(action, current_mark)
+                other = OPPONENT[current_mark]
+                canon_action = perm[action]
 
-                win = game.winner()
+                win = game.winner_cached
                 draw = game.is_draw()
                 if win or draw:
                     reward = 1.0 if win == current_mark else 0.0
-                    self.update(state, action, reward, None, None, True)
-                    other = "x" if current_mark == "o" else "o"
+                    self.update(state, canon_action, reward, None, None, True)
                     if other in last_sa:
                         other_state, other_action = last_sa[other]
                         other_reward = -1.0 if win else 0.0
                         self.update(other_state, other_action, other_reward, None, None, True)
                     break
 
-                other = "x" if current_mark == "o" else "o"
-                next_state = self.encode_state(game.board, other)
-                next_moves = game.available_moves()
-                self.update(state, action, 0.0, next_state, next_moves, False)
-                last_sa[current_mark] = (state, action)
+                digit = MARK_DIGIT[current_mark]
+                if game.turn < SYMMETRY_PLIES:
+                    keys = [key + digit * POW3[p[action]] for key, p in zip(keys, syms)]
+                    next_state, next_perm = self.canonical(keys, other)
+                else:
+                    keys[0] += digit * POW3[action]
+                    next_state, next_perm = (keys[0] << 1) | (other == "x"), identity
+                # 合法手は直前の一覧から打った手を除くだけでよい（盤面を走査し直さない）
+                next_moves = moves.copy()
+                next_moves.remove(action)
+                self.update(state, canon_action, 0.0, next_state, next_moves, False, next_perm)
+                last_sa[current_mark] = (state, canon_action)
                 current_mark = other
+                moves = next_moves
+                state = next_state
+                perm = next_perm
+
+    def train_parallel(self, episodes=TRAINING_EPISODES, workers=None):
+        """
+        自己対戦をプロセスに分けて並列に行い、各プロセスのQ表を平均して取り込む。
+        同じ (状態, 行動) が複数のプロセスにあれば平均する（多少の誤差はQ学習なので許容）。
+        各プロセスの結果は終わった順に1つずつ取り込んで捨てるので、全プロセスの表を同時には持たない。
+        """
+        workers = min(workers or os.cpu_count() or 1, episodes)
+        if workers <= 1:
+            self.train_self_play(episodes)
+            return
+
+        shares = [episodes // workers + (i < episodes % workers) for i in range(workers)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(train_worker, self.board_size, self.win_length,
+                                self.alpha, self.gamma, self.epsilon, share)
+                for share in shares
+            }
+
+            def finished_tables():
+                for future in concurrent.futures.as_completed(futures):
+                    # Future が結果のバイト列を握ったままにならないよう手放してから読む
+                    futures.discard(future)
+                    yield pickle.loads(future.result())
+
+            self.merge_tables(finished_tables())
+
+    def merge_tables(self, tables):
+        """
+        pack_table() 形式の表を順に受け取り、自分のQ表へ加える（tables はジェネレータでもよい）。
+        平均は実際に書き込まれたエントリ同士だけでとり、ある表に無いエントリを0.0として薄めることはしない。
+        """
+        q = self.q
+        counts = {}
+        for keys, values in tables:
+            for key, value in zip(self.unpack_keys(keys), values):
+                if key in q:
+                    q[key] += value
+                    counts[key] = counts.get(key, 1) + 1
+                else:
+                    q[key] = value
+                    self.states.add(key // self.n_actions)
+
+        for key, count in counts.items():
+            q[key] /= count
 
     def select_move(self, board, current_mark, available_moves):
-        state = self.encode_state(board, current_mark)
-        action = self.best_action(state, available_moves)
+        state, perm = self.encode_state(board, current_mark)
+        action = self.best_action(state, available_moves, perm)
         if action is None:
             return random.choice(available_moves)
         return action
 
 
+def train_worker(board_size, win_length, alpha, gamma, epsilon, episodes):
+    """train_parallel() の各プロセスで動く。学習したQ表をpickleして返す"""
+    # fork で親の乱数状態を引き継ぐとどのプロセスも同じ対局を繰り返すので、シードをやり直す
+    random.seed()
+    agent = QLearningAgent(board_size, win_length, alpha, gamma, epsilon)
+    agent.train_self_play(episodes)
+    return pickle.dumps(agent.pack_table(agent.q), protocol=pickle.HIGHEST_PROTOCOL)
+
+
 class UI:
     """表示・入力・メッセージ（tkinter依存）はここに集約"""
     def __init__(self):
@@ -212,12 +698,13 @@ class UI:
         if self.cpu_algorithm == "q":
             self.cpu_agent = QLearningAgent(self.game.board_size, self.game.win_length)
             if not self.cpu_agent.load_if_exists():
-                self.cpu_agent.train_self_play()
+                self.cpu_agent.train_parallel()
                 self.cpu_agent.save()
 
         self.canvas.bind("<Button-1>", self.on_click)
 
-        self.draw_board()
+        self.stone_items = {}
+        self.draw_grid()
 
         # CPU先手なら最初に一手
         if not self.game.human_first:
@@ -229,10 +716,10 @@ class UI:
     def choose_cpu_algorithm(self) -> str:
         use_q = messagebox.askyesno(
             "CPUアルゴリズム選択",
-            "CPUはQ学習を使いますか？\n\n「はい」= Q学習\n「いいえ」= ランダム",
+            "CPUはQ学習を使いますか？\n\n「はい」= Q学習\n「いいえ」= αβ探索",
             parent=self.root,
         )
-        return "q" if use_q else "random"
+        return "q" if use_q else "search"
 
     def index_from_event(self, event):
         col = event.x // CELL_SIZE
@@ -241,29 +728,31 @@ class UI:
             return row * BOARD_SIZE + col
         return None
 
-    def draw_board(self):
-        self.canvas.delete("all")
+    def draw_grid(self):
+        """格子は最初に一度だけ描く"""
         size = CELL_SIZE * BOARD_SIZE
-
-        # grid lines
         for i in range(BOARD_SIZE + 1):
             pos = i * CELL_SIZE
             self.canvas.create_line(pos, 0, pos, size, fill="#444")
             self.canvas.create_line(0, pos, size, pos, fill="#444")
 
-        # stones
-        for idx, mark in enumerate(self.game.board):
-            if mark is None:
-                continue
-            row, col = divmod(idx, BOARD_SIZE)
-            x1 = col * CELL_SIZE + 5
-            y1 = row * CELL_SIZE + 5
-            x2 = (col + 1) * CELL_SIZE - 5
-            y2 = (row + 1) * CELL_SIZE - 5
-            self.canvas.create_text((x1 + x2) / 2, (y1 + y2) / 2, text=mark, font=("Arial", CELL_SIZE // 2))
+    def place_stone(self, idx, mark):
+        """置かれた石1つだけを描き足す"""
+        row, col = divmod(idx, BOARD_SIZE)
+        x1 = col * CELL_SIZE + 5
+        y1 = row * CELL_SIZE + 5
+        x2 = (col + 1) * CELL_SIZE - 5
+        y2 = (row + 1) * CELL_SIZE - 5
+        self.stone_items[idx] = self.canvas.create_text(
+            (x1 + x2) / 2, (y1 + y2) / 2, text=mark, font=("Arial", CELL_SIZE // 2))
+
+    def clear_stones(self):
+        for item in self.stone_items.values():
+            self.canvas.delete(item)
+        self.stone_items.clear()
 
     def check_game_over(self) -> bool:
-        win = self.game.winner()
+        win = self.game.winner_cached
         result_text = None
         if win:
             winner_name = "You" if win == self.game.human_mark else "CPU"
@@ -295,13 +784,13 @@ class UI:
         if idx is None:
             return
         self.game.play(idx, self.game.cpu_mark)
-        self.draw_board()
+        self.place_stone(idx, self.game.cpu_mark)
         self.check_game_over()
 
     def start_new_game(self):
         human_first = self.choose_order()
         self.game.reset(human_first=human_first)
-        self.draw_board()
+        self.clear_stones()
         if not self.game.human_first:
             self.cpu_step()
 
@@ -317,11 +806,12 @@ class UI:
         if not self.game.play(idx, self.game.human_mark):
             return
 
-        self.draw_board()
+        self.place_stone(idx, self.game.human_mark)
         if self.check_game_over():
             return
 
-        # CPU move
+        # CPU move（考えている間も人の手が見えるよう、先に描画を済ませる）
+        self.canvas.update_idletasks()
         self.cpu_step()
 
     def run(self):